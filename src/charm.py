@@ -5,19 +5,20 @@
 # Learn more at: https://juju.is/docs/sdk
 
 import asyncio
-import glob
 import logging
 import os
-import socket
-from subprocess import DEVNULL, CalledProcessError, check_call
+import shlex
+import time
+from collections import defaultdict
+from subprocess import DEVNULL
 
-import paramiko
-from juju.controller import Controller
 from ops.charm import CharmBase
 from ops.framework import StoredState
 from ops.main import main
 from ops.model import ActiveStatus
 
+from sos_utils import Uploader
+
 logger = logging.getLogger(__name__)
 
 
@@ -26,12 +27,17 @@ class SosreportCharm(CharmBase):
 
     _stored = StoredState()
 
+    # Fixed part of the sos collect command line, tokenized once.
+    _SOS_COLLECT_ARGV = ("sos", "collect", "--no-local", "--nopasswd-sudo", "--batch")
+
     def __init__(self, *args):
         """Init."""
         super().__init__(*args)
 
-        self.controller = Controller(max_frame_size=6**24)
         self.logger = logger
+        self._controller = None
+        self._loop = None
+        self._stored.set_default(ip_cache={})
 
         self.framework.observe(self.on.install, self._on_install)
         self.framework.observe(
@@ -41,18 +47,50 @@ class SosreportCharm(CharmBase):
     def _on_install(self, _):
         self.model.unit.status = ActiveStatus("Unit is ready.")
 
+    @property
+    def controller(self):
+        """Return the juju Controller, importing the library on first use.
+
+        Importing juju pulls in websockets and friends, which is a
+        noticeable share of charm startup; hooks and actions that never
+        talk to the controller should not pay for it.
+        """
+        if self._controller is None:
+            from juju.controller import Controller
+
+            self._controller = Controller(max_frame_size=6**24)
+        return self._controller
+
+    @property
+    def loop(self):
+        """Return a lazily created event loop shared across invocations.
+
+        asyncio.run would build and tear down a loop per call, closing the
+        controller's websocket with it; keeping one loop alive lets the
+        juju login survive between coroutines.
+        """
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop
+
     def _on_collect_and_upload(self, event):
-        asyncio.run(self._on_collect_and_upload_async(event))
+        self.loop.run_until_complete(self._on_collect_and_upload_async(event))
 
     async def _on_collect_and_upload_async(self, event):
         """Collect sosreports an upload to remove server."""
-        ret, msg = await self._collect_sos(event)
+        try:
+            # Read the case id once for the whole action
+            case_id = event.params["case"]
+        except KeyError:
+            event.fail("Please specify a case number identifier")
+            return
+
+        ret, msg = await self._collect_sos(event, case_id)
         if not ret:
             event.fail(msg)
             return
 
-        case_id = event.params["case"]
-        files = glob.glob(f"/tmp/sos*{case_id}*")
+        files = self._get_reports(case_id)
         logger.info(files)
         ret, msg = self._upload_sos(files)
         if not ret:
@@ -62,11 +100,12 @@ class SosreportCharm(CharmBase):
 
         self._clear_local_sos(files)
 
-    async def _collect_sos(self, event):
+    async def _collect_sos(self, event, case_id):
         """Collect system state information and logs.
 
         Arguments:
         event -- an event object that contains information about the collection request.
+        case_id -- the support case identifier passed to sos collect.
 
         Returns:
         tuple -- a tuple of boolean indicating success or failure, and error message
@@ -86,38 +125,104 @@ class SosreportCharm(CharmBase):
 
         ips = await self._get_unit_ips(model, u, a)
         ssh_user = self.model.config["ssh-user"]
-        # Build the sos collect command
-        collect_cmd = f"sudo -u {ssh_user} sos collect --no-local \
-                        --nopasswd-sudo --batch --nodes {ips}"
-        collect_cmd = f"{collect_cmd} --ssh-user {ssh_user}"
-
-        try:
-            # Get the case id
-            case_id = event.params["case"]
-        except KeyError:
-            msg = "Please specify a case number identifier"
-            return False, msg
-
-        collect_cmd = f"{collect_cmd} --case-id {case_id}"
-        # Append any extra arguments if available
+        # Build the sos collect command as an argv list; exec-ing it
+        # directly skips the shell fork and parsing layer entirely.
+        collect_cmd = [
+            "sudo",
+            "-u",
+            ssh_user,
+            *self._SOS_COLLECT_ARGV,
+            "--ssh-user",
+            ssh_user,
+        ]
+
+        collect_cmd += ["--case-id", case_id]
+        # Append any extra arguments if available, tokenized up front so
+        # nothing is ever re-parsed by a shell.
         extra_args = event.params.get("extra-args")
         if extra_args:
-            collect_cmd = f"{collect_cmd} {extra_args}"
+            try:
+                collect_cmd += shlex.split(extra_args)
+            except ValueError as e:
+                return False, f"invalid extra-args: {e}"
+
+        node_list = [ip for ip in ips.split(",") if ip]
+        # Clamp so a non-positive setting degrades to a single process
+        # instead of producing zero shards and a vacuous success.
+        concurrency = max(1, min(self.model.config["collect-concurrency"], len(node_list)))
+        if concurrency == 1:
+            return await self._run_collect(collect_cmd + ["--nodes", ips])
+        return await self._collect_sharded(collect_cmd, node_list, concurrency)
+
+    async def _collect_sharded(self, collect_cmd, node_list, concurrency):
+        """Run one sos collect per node shard concurrently.
+
+        Collection is embarrassingly parallel per node, so the node list
+        is split across that many processes, each staging into its own
+        tmp dir to avoid collisions before merging back into /tmp where
+        the rest of the charm expects to find the reports.
+
+        Returns:
+        tuple -- a tuple of boolean indicating success or failure, and
+        error message if failure.
+        """
+        shards = [node_list[i::concurrency] for i in range(concurrency)]
+        shard_dirs = []
+        tasks = []
+        for i, shard in enumerate(shards):
+            shard_dir = f"/tmp/sos-shard-{i}"
+            os.makedirs(shard_dir, mode=0o777, exist_ok=True)
+            os.chmod(shard_dir, 0o777)
+            shard_dirs.append(shard_dir)
+            shard_cmd = collect_cmd + ["--nodes", ",".join(shard), "--tmp-dir", shard_dir]
+            tasks.append(self._run_collect(shard_cmd))
+        results = await asyncio.gather(*tasks)
+
+        for shard_dir in shard_dirs:
+            with os.scandir(shard_dir) as entries:
+                for entry in entries:
+                    os.replace(entry.path, f"/tmp/{entry.name}")
+            os.rmdir(shard_dir)
+
+        for ok, msg in results:
+            if not ok:
+                return False, msg
+        return True, None
 
-        logger.info(collect_cmd)
+    async def _run_collect(self, collect_cmd):
+        """Run one sos collect command without blocking the event loop.
 
+        Returns:
+        tuple -- a tuple of boolean indicating success or failure, and
+        error message if failure.
+        """
+        logger.info(" ".join(collect_cmd))
         try:
-            # Execute the sos collection command
-            check_call(collect_cmd, stdout=DEVNULL, shell=True)
-        except CalledProcessError as e:
-            msg = f"sos collection failed: {e.output}"
+            proc = await asyncio.create_subprocess_exec(*collect_cmd, stdout=DEVNULL)
+        except OSError as e:
+            msg = f"sos collection failed: {e}"
+            logger.error(msg)
+            return False, msg
+        returncode = await proc.wait()
+        if returncode != 0:
+            msg = f"sos collection failed with exit code {returncode}"
             logger.error(msg)
             return False, msg
 
         return True, None
 
+    def _get_reports(self, case_id):
+        """Return the sosreport files in /tmp belonging to a case.
+
+        A single scandir pass with plain string tests avoids glob's
+        pattern compile and per-entry stat, which matters when /tmp is
+        crowded on a busy host.
+        """
+        with os.scandir("/tmp") as entries:
+            return [e.path for e in entries if e.name.startswith("sos") and case_id in e.name]
+
     def _upload_sos(self, files):
-        """Upload files to the file server using SCP transfer.
+        """Upload files to the file server.
 
         Arguments:
         files -- list of file names to be uploaded
@@ -125,41 +230,33 @@ class SosreportCharm(CharmBase):
         Returns:
         tuple -- a tuple of boolean indicating success or failure and msg.
         """
-        file_server = self.model.config["server"]
-        username = self.model.config["server-username"]
-        password = self.model.config["server-password"]
-        # Loop through each file to upload
-        for file in files:
-            self._scp_transfer(file, file_server, ".", username, password)
+        try:
+            uploader = Uploader().create_uploader(
+                self.model.config["upload-method"],
+                server=self.model.config["server"],
+                username=self.model.config["server-username"],
+                password=self.model.config["server-password"],
+                concurrency=self.model.config["upload-concurrency"],
+                compress=self.model.config["upload-compression"],
+                recompress=self.model.config["upload-recompress"],
+            )
+        except NotImplementedError as e:
+            return False, str(e)
 
+        with uploader:
+            if not uploader.upload(files):
+                return False, "one or more sosreport uploads failed"
         return True, None
 
     def _clear_local_sos(self, files):
         """Remove local sosreport files after upload."""
         for file in files:
-            os.remove(file)
-
-    def _scp_transfer(self, src_file, dst_server, dst_path, username, password):
-        """Upload sosreport to ftp server."""
-        try:
-            client = paramiko.Transport((dst_server, 22))
-            client.connect(username=username, password=password)
-            sftp = client.open_sftp_client()
-
-            dst_file = src_file.split("/")[-1]
-            # If the file name begins with 'sosreport-', STS-API will add a
-            # comment to SF case.
-            # Rename the file from sos-collector* to sosreport*
-            dst_file = dst_file.replace("sos-collector", "sosreport", 1)
-            dst_file = dst_path + "/" + dst_file
-            logger.info(f"target file {dst_file}")
-            sftp.put(src_file, dst_file)
-
-            sftp.close()
-            client.close()
-        except (socket.error, paramiko.ssh_exception.AuthenticationException) as e:
-            logger.error(str(e))
-            return False, str(e)
+            try:
+                os.unlink(file)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"could not remove {file}: {e}")
 
     async def _connect_controller(self) -> None:
         if not self.controller.is_connected():
@@ -172,36 +269,53 @@ class SosreportCharm(CharmBase):
             )
 
     async def _get_unit_ips(self, model_name, units, applications):
+        # Serve repeat lookups from the stored cache so back-to-back
+        # actions skip the controller login and status round trip, which
+        # dominate wall time for interactive use.
+        ttl = self.model.config["ip-cache-ttl"]
+        cache_key = f"{model_name}|{','.join(units)}|{','.join(applications)}"
+        if ttl:
+            cached = self._stored.ip_cache.get(cache_key)
+            if cached is not None and time.time() - cached[0] < ttl:
+                return cached[1]
+
         unit_ips = []
         await self._connect_controller()
         model = await self.controller.get_model(model_name)
         status = await model.get_status()
         await model.disconnect()
 
+        # Index every unit address in one pass over the status snapshot so
+        # the per-application and per-unit lookups below become plain dict
+        # reads instead of repeated walks of the nested status structure.
+        app_index = defaultdict(list)
+        unit_index = {}
+        for app_name, app in status.applications.items():
+            for unit_name, unit in app.units.items():
+                address = str(unit.public_address)
+                app_index[app_name].append(address)
+                unit_index[unit_name] = address
+
         for application in applications:
             logger.info(
                 f"Getting public IPs for application {model_name}/{application}"
             )
-            try:
-                for unit in status.applications[application].units:
-                    unit_ips.append(
-                        str(status.applications[application].units[unit].public_address)
-                    )
-            except Exception as err:  # pylint: disable=W0703
-                logger.error(err)
+            if application in app_index:
+                unit_ips.extend(app_index[application])
+            else:
+                logger.error(f"no units found for application {application}")
 
         for unit in units:
-            # TOFIX
             logger.info(f"Getting public IP for unit {model_name}/{unit}")
-            application = unit.split("/", 1)[0]
-            try:
-                unit_ips.append(
-                    str(status.applications[application].units[unit].public_address)
-                )
-            except Exception as err:  # pylint: disable=W0703
-                logger.error(err)
+            if unit in unit_index:
+                unit_ips.append(unit_index[unit])
+            else:
+                logger.error(f"unit {unit} not found in model {model_name}")
 
-        return ",".join(unit_ips)
+        result = ",".join(unit_ips)
+        if ttl and result:
+            self._stored.ip_cache[cache_key] = [time.time(), result]
+        return result
 
 
 if __name__ == "__main__":